@@ -1,16 +1,43 @@
 import os
+import re
+import sys
+import json
 import time
+import hashlib
+import random
+import queue
+import atexit
 import logging
+import logging.handlers
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import dropbox
-from dropbox.exceptions import ApiError
+from dropbox.exceptions import ApiError, HttpError, InternalServerError, RateLimitError
 from dotenv import load_dotenv
+# Optional speedups (pip install orjson "httpx[http2]"): orjson parses listing pages
+# faster, and httpx with h2 sends every request over shared HTTP/2 connections.
+# Without them the tool falls back to json and the SDK's requests session.
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
-# Setup logging with timestamps
-logging.basicConfig(
-    filename='cleanup_log.txt',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Setup logging with timestamps. Worker threads only enqueue records; a listener
+# thread writes them to the log file so disk I/O never sits between API calls.
+log_queue = queue.Queue(-1)
+log_file_handler = logging.FileHandler('cleanup_log.txt')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # Load environment variables
 load_dotenv()
@@ -18,100 +45,482 @@ DROPBOX_ACCESS_TOKEN = os.getenv("DROPBOX_ACCESS_TOKEN")
 if not DROPBOX_ACCESS_TOKEN:
     raise ValueError("DROPBOX_ACCESS_TOKEN not found in .env file.")
 
-# Initialize Dropbox client with your friend’s token
-dbx = dropbox.Dropbox(DROPBOX_ACCESS_TOKEN)
+# Maximum number of entries Dropbox returns per list_folder page
+LIST_PAGE_LIMIT = 2000
 
-# Step 1: Check for "memo" in filename
-def has_memo_in_filename(filename):
-    return 'memo' in filename.lower()
+# Maximum number of entries accepted by files_move_batch_v2
+MOVE_BATCH_SIZE = 1000
 
-# Step 2: List folder contents using Dropbox API
-def list_dropbox_folder(dbx, folder_path, recursive=True):
-    result = {
-        'memo_files': [],
-        'other_files': [],
-        'folders': []
-    }
-    try:
-        response = dbx.files_list_folder(folder_path, recursive=recursive)
-        for entry in response.entries:
-            if isinstance(entry, dropbox.files.FileMetadata):
-                if has_memo_in_filename(entry.name):
-                    result['memo_files'].append(entry.path_lower)
-                else:
-                    result['other_files'].append(entry.path_lower)
-            elif isinstance(entry, dropbox.files.FolderMetadata):
-                result['folders'].append(entry.path_lower)
-        
-        while response.has_more:
-            response = dbx.files_list_folder_continue(response.cursor)
-            for entry in response.entries:
-                if isinstance(entry, dropbox.files.FileMetadata):
-                    if has_memo_in_filename(entry.name):
-                        result['memo_files'].append(entry.path_lower)
+# Minimal requests.Session-style wrapper so the SDK can post through an httpx client.
+# Certificate verification is fixed on the client, and streamed (download) routes are
+# not used by this tool, so requests asking for either are rejected rather than ignored.
+class HttpxSession:
+    def __init__(self, client):
+        self.client = client
+
+    def post(self, url, headers=None, data=None, stream=False, verify=True, timeout=None):
+        if stream or verify is not True:
+            raise ValueError("HttpxSession only supports verified, non-streaming requests")
+        return self.client.post(url, headers=headers, content=data, timeout=timeout)
+
+    def close(self):
+        self.client.close()
+
+# HTTP session shared by the SDK and the raw listing requests. With httpx and h2
+# installed, all requests multiplex over a few HTTP/2 connections; otherwise the
+# SDK's default requests session keeps connections alive between calls. Only the
+# listing thread and the single move worker use it, so its default pool suffices.
+def create_http_session():
+    if httpx is not None:
+        try:
+            # httpx's default verification (certifi) matches what the SDK's requests session uses
+            return HttpxSession(httpx.Client(
+                http2=True,
+                verify=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+            ))
+        except ImportError:
+            logging.info("h2 is not installed, falling back to HTTP/1.1 via requests")
+    return dropbox.create_session()
+
+http_session = create_http_session()
+if isinstance(http_session, HttpxSession):
+    # httpx logs every request at INFO, duplicating the SDK's own "Request to" lines
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Dropbox client that sends every call through an HttpxSession. The SDK only accepts
+# a requests.Session in its constructor, so the session it builds there is closed
+# and replaced.
+class HttpxDropbox(dropbox.Dropbox):
+    def __init__(self, oauth2_access_token, session, **kwargs):
+        super().__init__(oauth2_access_token, **kwargs)
+        self._session.close()
+        self._session = session
+
+# Initialize Dropbox client with your friend’s token (shared by all worker threads).
+# The SDK's own retries are disabled so _with_retry is the single retry policy.
+if isinstance(http_session, HttpxSession):
+    dbx = HttpxDropbox(
+        DROPBOX_ACCESS_TOKEN,
+        http_session,
+        max_retries_on_error=0,
+        max_retries_on_rate_limit=0
+    )
+else:
+    dbx = dropbox.Dropbox(
+        DROPBOX_ACCESS_TOKEN,
+        max_retries_on_error=0,
+        max_retries_on_rate_limit=0,
+        session=http_session
+    )
+
+# Client-side token bucket shared by all worker threads
+class TokenBucket:
+    def __init__(self, rate=9, capacity=18):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.condition.wait((1 - self.tokens) / self.rate)
+
+# Dropbox limits reads and writes separately; stay at ~90% of 600 requests/minute for each
+READ_BUCKET = TokenBucket()
+WRITE_BUCKET = TokenBucket()
+
+# Call a Dropbox API method, retrying on rate limits and server errors
+def _with_retry(fn, *args, max_tries=6, bucket=READ_BUCKET, **kwargs):
+    for attempt in range(max_tries):
+        bucket.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except RateLimitError as e:
+            if attempt == max_tries - 1:
+                raise
+            # Honor the server's Retry-After, falling back to exponential backoff with jitter
+            delay = float(e.backoff) if e.backoff is not None else 2 ** attempt + random.random()
+            logging.warning(f"Rate limited on {fn.__name__}, retrying in {delay:.1f} seconds")
+        except InternalServerError as e:
+            if attempt == max_tries - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            logging.warning(f"Server error {e.status_code} on {fn.__name__}, retrying in {delay:.1f} seconds")
+        time.sleep(delay)
+
+# Step 1: Stream the whole folder tree as (kind, path) entries from one recursive listing
+# Each listed page is journaled with the cursor that follows it, and each finished move
+# batch with the paths it moved, so an interrupted run resumes the listing without
+# losing the entries already seen or repeating moves that already succeeded
+class ListingJournal:
+    def __init__(self, root):
+        self.path = f"cursor_{hashlib.sha1(root.encode('utf-8')).hexdigest()[:16]}.jsonl"
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.page_count = 0
+        self.moved = set()
+        self.size = 0
+        self._scan()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def _scan(self):
+        # Keep only the last cursor and the moved paths; page entries are streamed by replay()
+        try:
+            with open(self.path, 'rb') as journal:
+                for line in journal:
+                    if not line.endswith(b'\n'):
+                        break  # Partial last line from an interrupted write
+                    record = json.loads(line)
+                    if 'moved' in record:
+                        self.moved.update(record['moved'])
                     else:
-                        result['other_files'].append(entry.path_lower)
-                elif isinstance(entry, dropbox.files.FolderMetadata):
-                    result['folders'].append(entry.path_lower)
-    except ApiError as e:
-        logging.error(f"Error listing Dropbox folder {folder_path}: {e}")
-    return result
+                        self.cursor = record['cursor']
+                        self.page_count += 1
+                    self.size += len(line)
+        except FileNotFoundError:
+            return
+        # Drop any partial line so new records append cleanly
+        os.truncate(self.path, self.size)
+
+    def replay(self):
+        # Only the records found by _scan; anything after them was appended by this run
+        remaining = self.size
+        with open(self.path, 'rb') as journal:
+            for line in journal:
+                if remaining <= 0:
+                    break
+                remaining -= len(line)
+                record = json.loads(line)
+                if 'entries' in record:
+                    for kind, path in record['entries']:
+                        yield kind, path
+
+    def restart(self):
+        # Moved items are gone from the source, so a fresh listing will not see them;
+        # forget them along with the pages so memory and disk stay in step
+        with self.lock:
+            self.file.truncate(0)
+            self.cursor = None
+            self.page_count = 0
+            self.moved.clear()
+            self.size = 0
+
+    def _write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def save_page(self, cursor, page):
+        self._write({'cursor': cursor, 'entries': page})
+
+    def save_moved(self, paths):
+        if paths:
+            self._write({'moved': paths})
+
+    def close(self, remove=False):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+# Call a list_folder endpoint directly so entries stay plain JSON instead of SDK objects,
+# raising the same exceptions as the SDK so _with_retry applies unchanged
+def _list_folder_request(endpoint, body):
+    response = http_session.post(
+        f"https://api.dropboxapi.com/2/files/{endpoint}",
+        headers={
+            'Authorization': f"Bearer {DROPBOX_ACCESS_TOKEN}",
+            'Content-Type': 'application/json'
+        },
+        data=json.dumps(body),
+        timeout=100
+    )
+    request_id = response.headers.get('x-dropbox-request-id')
+    if response.status_code == 200:
+        return json_loads(response.content)
+    if response.status_code == 409:
+        raise ApiError(request_id, json_loads(response.content).get('error'), None, None)
+    if response.status_code == 429:
+        raise RateLimitError(request_id, None, response.headers.get('Retry-After'))
+    if response.status_code >= 500:
+        raise InternalServerError(request_id, response.status_code, response.text)
+    raise HttpError(request_id, response.status_code, response.text)
+
+def list_folder(folder_path, recursive=True):
+    # Ask for the largest pages and no optional metadata. Mounted and non-downloadable
+    # entries stay in, since they decide whether a folder holds only a memo.
+    return _list_folder_request('list_folder', {
+        'path': folder_path,
+        'recursive': recursive,
+        'include_media_info': False,
+        'include_deleted': False,
+        'include_has_explicit_shared_members': False,
+        'limit': LIST_PAGE_LIMIT
+    })
+
+def list_folder_continue(cursor):
+    return _list_folder_request('list_folder/continue', {'cursor': cursor})
+
+# Check for "memo" in filename without allocating a lowercased copy
+has_memo_in_filename = re.compile(r'memo', re.IGNORECASE).search
 
-# Step 3: Move a file or folder to the archive
-def move_to_archive(dbx, source_path, archive_path, dry_run=True):
+# Classify one page of listing entries, reading only '.tag', 'name' and 'path_lower'
+def _partition(entries):
+    page = []
+    page_append = page.append
+    for entry in entries:
+        tag = entry['.tag']
+        if tag == 'file':
+            page_append(('memo' if has_memo_in_filename(entry['name']) else 'other', entry['path_lower']))
+        elif tag == 'folder':
+            page_append(('folder', entry['path_lower']))
+    return page
+
+def iter_dropbox_folder(folder_path, journal, recursive=True):
+    response = None
+    if journal.cursor is not None:
+        try:
+            response = _with_retry(list_folder_continue, journal.cursor)
+        except ApiError as e:
+            logging.warning(f"Saved cursor for {folder_path} is no longer valid, listing from the start: {e}")
+            journal.restart()
+        else:
+            logging.info(
+                f"Resuming listing of {folder_path} from {journal.page_count} saved pages, "
+                f"skipping {len(journal.moved)} items already moved"
+            )
+            yield from journal.replay()
+
+    if response is None:
+        response = _with_retry(list_folder, folder_path, recursive=recursive)
+    page = _partition(response['entries'])
+    journal.save_page(response['cursor'], page)
+    yield from page
+    
+    while response['has_more']:
+        response = _with_retry(list_folder_continue, response['cursor'])
+        page = _partition(response['entries'])
+        journal.save_page(response['cursor'], page)
+        yield from page
+
+# Step 2: Move files and folders to the archive in batches
+def archive_relocation(source_path, archive_path):
+    # Keep the leading '/' of the basename; Dropbox paths never use os.sep
+    return dropbox.files.RelocationPath(source_path, archive_path + source_path[source_path.rfind('/'):])
+
+def _move_batch_dry(dbx, relocations, journal):
+    for relocation in relocations:
+        logging.info(f"[DRY RUN] Would move {relocation.from_path} to {relocation.to_path}")
+    return len(relocations)
+
+def _run_move_batch(dbx, relocations):
+    # autorename lets the server resolve name clashes in the archive in the same request
+    launch = _with_retry(
+        dbx.files_move_batch_v2,
+        relocations,
+        autorename=True,
+        allow_ownership_transfer=True,
+        bucket=WRITE_BUCKET
+    )
+    if launch.is_async_job_id():
+        job_id = launch.get_async_job_id()
+        status = _with_retry(dbx.files_move_batch_check_v2, job_id)
+        while status.is_in_progress():
+            time.sleep(1)
+            status = _with_retry(dbx.files_move_batch_check_v2, job_id)
+        return status.get_complete()
+    return launch.get_complete()
+
+def _move_batch_real(dbx, relocations, journal, max_tries=6):
+    moved = 0
+    for attempt in range(max_tries):
+        try:
+            result = _run_move_batch(dbx, relocations)
+        except ApiError as e:
+            logging.error(f"Error moving batch of {len(relocations)} items: {e}")
+            return moved
+
+        # Entries that hit write-lock contention are resubmitted; other failures are final
+        contended = []
+        succeeded = []
+        for relocation, outcome in zip(relocations, result.entries):
+            if outcome.is_success():
+                # Report the final path, which differs from to_path when the server renamed it
+                logging.info(f"Moved {relocation.from_path} to {outcome.get_success().path_display}")
+                succeeded.append(relocation.from_path)
+            elif outcome.is_failure() and outcome.get_failure().is_too_many_write_operations():
+                contended.append(relocation)
+            else:
+                error = outcome.get_failure() if outcome.is_failure() else outcome
+                logging.error(f"Error moving {relocation.from_path} to {relocation.to_path}: {error}")
+        # Record what moved so a resumed run does not queue it again
+        journal.save_moved(succeeded)
+        moved += len(succeeded)
+        if not contended:
+            return moved
+        if attempt == max_tries - 1:
+            for relocation in contended:
+                logging.error(f"Error moving {relocation.from_path} to {relocation.to_path}: too_many_write_operations")
+            return moved
+        delay = 2 ** attempt + random.random()
+        logging.warning(f"{len(contended)} moves hit too_many_write_operations, retrying in {delay:.1f} seconds")
+        time.sleep(delay)
+        relocations = contended
+    return moved
+
+# Chosen once in main, so batch submission never re-checks dry_run
+move_batch = _move_batch_dry
+
+def move_to_archive(executor, dbx, relocations, journal):
+    return [
+        executor.submit(move_batch, dbx, relocations[i:i + MOVE_BATCH_SIZE], journal)
+        for i in range(0, len(relocations), MOVE_BATCH_SIZE)
+    ]
+
+# Step 3: Partition the streamed listing, moving memo files as soon as their placement is known
+_INELIGIBLE = object()
+
+def process_folder(executor, dbx, folder_path, archive_path, delete_empty_folders=True):
+    journal = ListingJournal(folder_path.lower())
+    futures = []
+    completed = False
     try:
-        target_path = f"{archive_path}/{os.path.basename(source_path)}"
-        if dry_run:
-            logging.info(f"[DRY RUN] Would move {source_path} to {target_path}")
-            return True
-        dbx.files_move_v2(dropbox.files.RelocationArg(source_path, target_path))
-        logging.info(f"Moved {source_path} to {target_path}")
-        return True
-    except ApiError as e:
-        logging.error(f"Error moving {source_path} to {target_path}: {e}")
-        return False
+        completed = _process_listing(executor, dbx, folder_path, archive_path, journal, futures)
+    finally:
+        # Batches still running record their moves in the journal, so let them finish
+        # even when listing failed. The journal is only removed once everything finished.
+        wait(futures)
+        journal.close(remove=completed)
 
-# Step 4: Process folder recursively
-def process_folder(dbx, folder_path, archive_path, delete_empty_folders=True, dry_run=True):
+def _process_listing(executor, dbx, folder_path, archive_path, journal, futures):
     logging.info(f"Processing folder: {folder_path}")
-    contents = list_dropbox_folder(dbx, folder_path, recursive=False)
-    logging.info(f"Found {len(contents['memo_files'])} memo files, {len(contents['other_files'])} other files, and {len(contents['folders'])} folders.")
-
-    # Move memo files to archive
-    for file in contents['memo_files']:
-        move_to_archive(dbx, file, archive_path, dry_run)
-
-    # Move folders with exactly one memo file to archive
-    for folder in contents['folders']:
-        subfolder_path = folder
-        subfolder_contents = list_dropbox_folder(dbx, subfolder_path, recursive=False)
-        if (len(subfolder_contents['memo_files']) == 1 and 
-            not subfolder_contents['other_files'] and 
-            not subfolder_contents['folders']):
-            move_to_archive(dbx, subfolder_path, archive_path, dry_run)
-        else:
-            process_folder(dbx, subfolder_path, archive_path, delete_empty_folders, dry_run)
+    root = sys.intern(folder_path.lower())
+    archive_root = sys.intern(archive_path.lower())
+    archive_prefix = archive_root + '/'
+    # Per subfolder: None while it has no children, the memo path while that memo is its
+    # only child, and _INELIGIBLE once it holds anything else
+    folders = {archive_root: _INELIGIBLE}
+    file_moves = []
+    memo_count = other_count = folder_count = 0
+    queued = already_moved = 0
+    listing_complete = True
+
+    def move_file(path):
+        nonlocal queued, already_moved
+        if path in journal.moved:
+            already_moved += 1
+            return
+        queued += 1
+        file_moves.append(archive_relocation(path, archive_path))
+        if len(file_moves) == MOVE_BATCH_SIZE:
+            futures.extend(move_to_archive(executor, dbx, file_moves.copy(), journal))
+            file_moves.clear()
+
+    try:
+        for kind, path in iter_dropbox_folder(folder_path, journal):
+            # Skip the root itself and anything already in the archive
+            if path == root or path.startswith(archive_prefix):
+                continue
+            if kind == 'memo':
+                memo_count += 1
+            elif kind == 'other':
+                other_count += 1
+            else:
+                folder_count += 1
+                path = sys.intern(path)
+                if path not in folders:
+                    folders[path] = None
 
-# Step 5: Main function
+            # Interned so every sibling shares one parent string and lookups in
+            # folders match by identity before comparing characters
+            parent = sys.intern(path[:path.rfind('/')])
+            if parent == root:
+                if kind == 'memo':
+                    move_file(path)
+                continue
+            state = folders.get(parent)
+            if state is None:
+                folders[parent] = path if kind == 'memo' else _INELIGIBLE
+            elif state is _INELIGIBLE:
+                if kind == 'memo':
+                    move_file(path)
+            else:
+                # A second child: the pending memo can no longer move with its folder
+                folders[parent] = _INELIGIBLE
+                move_file(state)
+                if kind == 'memo':
+                    move_file(path)
+    except ApiError as e:
+        logging.error(f"Error listing Dropbox folder {folder_path}: {e}")
+        listing_complete = False
+    logging.info(f"Found {memo_count} memo files, {other_count} other files, and {folder_count} folders.")
+
+    # Move memo files first, then the single-memo folders
+    if file_moves:
+        futures.extend(move_to_archive(executor, dbx, file_moves, journal))
+    wait(futures)
+    moved = sum(future.result() for future in futures)
+
+    folder_moves = [
+        archive_relocation(folder, archive_path)
+        for folder, state in folders.items()
+        if state is not None and state is not _INELIGIBLE and folder not in journal.moved
+    ]
+    if not listing_complete:
+        # Unseen entries could still make these folders ineligible
+        logging.error(f"Listing of {folder_path} did not complete, skipping {len(folder_moves)} single-memo folders.")
+        folder_moves = []
+    folder_futures = move_to_archive(executor, dbx, folder_moves, journal)
+    futures.extend(folder_futures)
+    wait(folder_futures)
+    moved += sum(future.result() for future in folder_futures)
+    logging.info(f"Moved {moved} of {queued + len(folder_moves)} items from {folder_path}.")
+    if already_moved:
+        logging.info(f"Skipped {already_moved} items already moved by an earlier run.")
+    return listing_complete
+
+# Step 4: Main function
 def main():
+    global move_batch
     logging.info("Dropbox Folder Memo File Cleanup Tool started")
     print("Dropbox Folder Memo File Cleanup Tool")
     print("---------------------------------")
+    missing = []
+    if orjson is None:
+        missing.append('orjson')
+    if not isinstance(http_session, HttpxSession):
+        missing.append('"httpx[http2]"')
+    if missing:
+        print(f"Optional speedups not installed: pip install {' '.join(missing)}")
     
     dropbox_folder_paths = [
         "/renee killelea/$ jlr data migration/david"  # Source path
     ]
     archive_path = "/renee killelea/$ jlr data migration/david/archive"  # Archive path
+    dry_run = True
+    move_batch = _move_batch_dry if dry_run else _move_batch_real
     
-    for folder_path in dropbox_folder_paths:
-        try:
-            print(f"\nProcessing folder: {folder_path}")
-            start_time = time.time()
-            process_folder(dbx, folder_path, archive_path, dry_run=True)
-            print(f"Completed in {time.time() - start_time:.2f} seconds")
-        except Exception as e:
-            logging.error(f"Error processing folder {folder_path}: {e}")
-            print(f"Error processing folder {folder_path}: {e}")
+    # Move batches run one at a time, overlapping only with listing. The earlier
+    # 12-way move concurrency was dropped on purpose: concurrent batches writing into
+    # the same archive folder contend for its lock and fail with too_many_write_operations.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for folder_path in dropbox_folder_paths:
+            try:
+                print(f"\nProcessing folder: {folder_path}")
+                start_time = time.time()
+                process_folder(executor, dbx, folder_path, archive_path)
+                print(f"Completed in {time.time() - start_time:.2f} seconds")
+            except Exception as e:
+                logging.error(f"Error processing folder {folder_path}: {e}")
+                print(f"Error processing folder {folder_path}: {e}")
     
     print("\nAnalysis and cleanup process completed! Set dry_run=False to perform actual moves.")
     logging.info("Analysis and cleanup process completed.")